@@ -1,73 +1,543 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from fastapi import FastAPI, HTTPException, Response
+from fastapi.concurrency import iterate_in_threadpool, run_in_threadpool
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig, TextIteratorStreamer
+from transformers.pytorch_utils import Conv1D
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Literal
+import asyncio
+import base64
+import os
+import orjson
+import threading
 import torch
 
-app = FastAPI()
+def env_list(name: str, default: str) -> list[str]:
+    """Comma-separated environment variable as a list, ignoring blanks and surrounding whitespace."""
+    return [item.strip() for item in os.getenv(name, default).split(",") if item.strip()]
+
+# Comma-separated models to load (and warm up) at startup, so the first request is not the one
+# paying for disk I/O and compilation. Set to an empty string to load lazily instead.
+PRELOAD_MODELS = env_list("PRELOAD_MODELS", "distilgpt2")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Preload PRELOAD_MODELS through a dummy request before the server starts accepting traffic.
+
+    Preloading goes through the same substitution and allowlist as requests, so it cannot load
+    a model that requests could never use.
+    """
+    for model_name in PRELOAD_MODELS:
+        try:
+            model_name_to_use = resolve_model_name(model_name)
+        except HTTPException:
+            print(f"Not preloading {model_name}: it is not in ALLOWED_MODELS.")
+            continue
+        try:
+            # Warm up the default request path (eager attention, with generation) end to end
+            await run_in_threadpool(run_batch, model_name_to_use, ["Hello world"], max_new_tokens=8)
+        except Exception as e:
+            print(f"Failed to preload {model_name}, it will be loaded on first use: {str(e)}")
+    yield
+
+app = FastAPI(lifespan=lifespan)
+
+# Using a smaller model for testing purposes if a large model is specified.
+# This is to avoid long download times in the execution environment.
+# The code is structured to work with larger models like "meta-llama/Meta-Llama-3-8B-Instruct".
+MODEL_SUBSTITUTIONS = {
+    "meta-llama/Meta-Llama-3-8B-Instruct": "distilgpt2",
+    "mistralai/Mistral-7B-Instruct-v0.2": "distilgpt2",
+}
+# Models the server will load (after substitution); anything else is rejected before any
+# tokenizer/model lookup. Comma-separated override via the ALLOWED_MODELS environment variable.
+ALLOWED_MODELS = frozenset(env_list("ALLOWED_MODELS", "distilgpt2"))
+
+# Longest prompt (in tokens) accepted; attentions alone are num_layers x num_heads x seq_len ** 2.
+MAX_PROMPT_TOKENS = int(os.getenv("MAX_PROMPT_TOKENS", "512"))
+
+# Dynamic batching: concurrent prompts for the same model that arrive within a short window
+# are padded into one tokenizer/generate call instead of running one by one.
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+BATCH_WINDOW_MS = float(os.getenv("BATCH_WINDOW_MS", "10"))
+
+# Upper bound on batches running inference at once. Models are shared by every request in the
+# process, so this caps activation memory (and GPU OOMs) under concurrent load, not model copies.
+INFER_SEMAPHORE = asyncio.Semaphore(int(os.getenv("INFER_CONCURRENCY", "2")))
+
+# Run on the GPU in bfloat16 when one is available, otherwise fall back to CPU float32.
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+DTYPE = torch.bfloat16 if DEVICE == "cuda" else torch.float32
+
+# Opt-in: INT8 weights roughly halve memory traffic on the (memory-bound) forward pass.
+# Uses bitsandbytes on CUDA (must be installed separately) and torchao dynamic quantization on CPU.
+QUANTIZE_INT8 = os.getenv("QUANTIZE_INT8", "0") == "1"
+
+# Opt-in: compiling trades a slow one-time warmup for lower per-token latency afterwards.
+TORCH_COMPILE = os.getenv("TORCH_COMPILE", "0") == "1"
+
+WARMUP_PROMPTS = ["Hello world", "The quick brown fox jumps over the lazy dog"]
+
+def compile_model(model, tokenizer, output_attentions: bool):
+    """Compile the model's forward pass and warm it up, falling back to eager on failure."""
+    eager_forward = model.forward
+    try:
+        # Compile forward rather than the module so that model.generate() picks it up. dynamic=True
+        # traces symbolic sequence/batch sizes instead of recompiling for every new prompt length.
+        model.forward = torch.compile(eager_forward, mode="reduce-overhead", dynamic=True)
+        # Warm up at load time, through the same calls run_batch makes, so the first real request
+        # doesn't pay the compile cost. Two prompt lengths get past the first shape specialization.
+        for prompt in WARMUP_PROMPTS:
+            warmup_inputs = {k: v.to(DEVICE) for k, v in tokenizer([prompt], return_tensors="pt").items()}
+            for generate in (True, False):
+                run_model(model, tokenizer, warmup_inputs, output_attentions, generate, max_new_tokens=4)
+    except Exception as e:
+        print(f"torch.compile failed, falling back to eager mode: {str(e)}")
+        model.forward = eager_forward
+    return model
+
+def conv1d_to_linear(model):
+    """Swap GPT-2 style Conv1D layers for equivalent nn.Linear layers, in place.
+
+    Conv1D is a linear layer with transposed weights, but quantizers only recognize nn.Linear,
+    so without this GPT-2 models would keep every attention/MLP projection in full precision.
+    """
+    for module in list(model.modules()):
+        for child_name, child in list(module.named_children()):
+            if isinstance(child, Conv1D):
+                linear = torch.nn.Linear(child.nx, child.nf, dtype=child.weight.dtype, device=child.weight.device)
+                with torch.no_grad():
+                    linear.weight.copy_(child.weight.t())
+                    linear.bias.copy_(child.bias)
+                setattr(module, child_name, linear)
+    return model
+
+def quantize_int8_cpu(model):
+    """Quantize every linear projection to INT8 weights with dynamic INT8 activations."""
+    # Imported lazily: torchao is only needed (and only pays its import cost) when quantizing.
+    from torchao.quantization import Int8DynamicActivationInt8WeightConfig, quantize_
+
+    conv1d_to_linear(model)
+    # A tied lm_head gets its own INT8 weight; each decode step reads that instead of the
+    # full-precision embedding matrix.
+    quantize_(model, Int8DynamicActivationInt8WeightConfig())
+    return model
+
+def load_causal_lm(model_name: str, attn_implementation: str):
+    """Load the model weights on DEVICE, quantized to INT8 if QUANTIZE_INT8 is set."""
+    if QUANTIZE_INT8 and DEVICE == "cuda":
+        try:
+            # device_map places the 8-bit weights itself, so the model must not be moved afterwards.
+            return AutoModelForCausalLM.from_pretrained(
+                model_name,
+                quantization_config=BitsAndBytesConfig(load_in_8bit=True),
+                device_map="auto",
+                attn_implementation=attn_implementation,
+            )
+        except ImportError as e:
+            print(f"8-bit loading unavailable, falling back to {DTYPE}: {str(e)}")
+            return AutoModelForCausalLM.from_pretrained(
+                model_name, dtype=DTYPE, attn_implementation=attn_implementation
+            ).to(DEVICE)
+
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name, dtype=DTYPE, attn_implementation=attn_implementation
+    ).to(DEVICE)
+    if QUANTIZE_INT8:
+        model = quantize_int8_cpu(model)
+    return model
+
+@lru_cache(maxsize=4)
+def load_model(model_name: str, return_attentions: bool):
+    """Load a tokenizer/model pair; cached, but only call it through get_model().
+
+    The fused SDPA attention kernel never materializes the attention matrix, so it cannot
+    return attention maps. Models that need to return them are loaded with the eager
+    implementation and cached separately from the SDPA variant.
+    """
+    attn_implementation = "eager" if return_attentions else "sdpa"
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = load_causal_lm(model_name, attn_implementation)
+    model.eval()
+    # Ensure pad_token_id is set for open-ended generation if not already set
+    if model.config.pad_token_id is None:
+        model.config.pad_token_id = tokenizer.eos_token_id
+    # Batched prompts are padded on the left so that generation continues right after each prompt.
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
+    # Quantized kernels don't compose reliably with torch.compile, so quantized models stay eager.
+    if TORCH_COMPILE and not QUANTIZE_INT8:
+        model = compile_model(model, tokenizer, output_attentions=return_attentions)
+    return tokenizer, model
+
+# lru_cache doesn't stop two concurrent misses from both running the loader, and requests for
+# the same model can overlap in several ways (INFER_CONCURRENCY > 1, batches with different
+# settings, the stream endpoint). One lock per model variant makes the second caller wait for
+# the first load instead of downloading, loading and compiling its own copy.
+model_load_locks: dict[tuple, threading.Lock] = {}
+model_load_locks_guard = threading.Lock()
+
+def get_model(model_name: str, return_attentions: bool = True):
+    """Load a tokenizer/model pair once and reuse it across requests."""
+    key = (model_name, return_attentions)
+    with model_load_locks_guard:
+        lock = model_load_locks.setdefault(key, threading.Lock())
+    with lock:
+        return load_model(model_name, return_attentions)
+
+def run_model(model, tokenizer, inputs, return_attentions: bool, generate: bool, max_new_tokens: int, streamer=None):
+    """Run the model over already tokenized inputs.
+
+    Returns (generated ids or None, per-layer prompt attentions, per-layer prompt hidden states).
+    """
+    # inference_mode skips autograd bookkeeping (version counters, saved tensors) we never use.
+    with torch.inference_mode():
+        if generate:
+            # A single generate() call yields both the generated ids and the attentions/hidden
+            # states. For decoder-only models (like GPT2) these are tuples per generation step;
+            # step 0 is the prefill over the full prompt, i.e. exactly what a standalone forward
+            # pass would return. use_cache keeps the prompt's keys/values after prefill, so each
+            # decode step only runs the newest token instead of re-attending over the sequence.
+            outputs = model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                pad_token_id=tokenizer.eos_token_id,
+                use_cache=True,
+                return_dict_in_generate=True,
+                output_attentions=return_attentions,
+                output_hidden_states=True,
+                streamer=streamer,
+            )
+            sequences = outputs.sequences
+            prompt_attentions = outputs.attentions[0] if outputs.attentions else ()
+            prompt_hidden_states = outputs.hidden_states[0] if outputs.hidden_states else ()
+        else:
+            # Introspection only: one forward pass over the prompt instead of the decode loop.
+            # Unlike generate(), a plain forward pass numbers positions from 0 across the left
+            # padding, so derive them from the mask to match an unpadded run of each prompt.
+            position_ids = (inputs["attention_mask"].cumsum(dim=-1) - 1).clamp(min=0)
+            outputs = model(
+                **inputs,
+                position_ids=position_ids,
+                output_attentions=return_attentions,
+                output_hidden_states=True,
+            )
+            sequences = None
+            prompt_attentions = outputs.attentions or ()
+            prompt_hidden_states = outputs.hidden_states or ()
+    return sequences, prompt_attentions, prompt_hidden_states
+
+def prompt_length_error(prompt_length: int) -> HTTPException | None:
+    """The error for a prompt of prompt_length tokens, or None if it can be run.
+
+    Empty prompts get a 400 (there is nothing to attend over), oversized ones a 413.
+    """
+    if prompt_length == 0:
+        return HTTPException(status_code=400, detail="Prompt is empty.")
+    if prompt_length > MAX_PROMPT_TOKENS:
+        return HTTPException(
+            status_code=413,
+            detail=f"Prompt is {prompt_length} tokens long; the limit is {MAX_PROMPT_TOKENS}.",
+        )
+    return None
+
+def run_batch(
+    model_name: str,
+    prompts: list[str],
+    return_attentions: bool = True,
+    generate: bool = True,
+    max_new_tokens: int = 50,
+    streamer=None,
+):
+    """Run one padded generate() call over prompts and split the outputs back per prompt.
+
+    Attentions ([num_layers, num_heads, seq_len, seq_len]) and hidden states
+    ([num_layers + 1, seq_len, hidden_size]) are returned as float16 CPU tensors; formatting
+    them for the response is left to the caller. Empty prompts and prompts longer than
+    MAX_PROMPT_TOKENS get an HTTPException in place of their result. A streamer, if given, is passed on to generate().
+    """
+    try:
+        tokenizer, model = get_model(model_name, return_attentions)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error loading model: {str(e)}")
+
+    try:
+        encoded = tokenizer(prompts, return_tensors="pt", padding=True)
+        prompt_lengths = encoded["attention_mask"].sum(dim=1).tolist()
+
+        # Admission control: attention cost and output size grow with seq_len ** 2, so oversized
+        # prompts are rejected individually rather than dragging the whole batch down with them.
+        # Empty prompts are rejected too: slicing their zero columns out of the batch would
+        # otherwise return whichever prompts they happened to be batched with.
+        results = [None] * len(prompts)
+        rows = []
+        for i, prompt_length in enumerate(prompt_lengths):
+            error = prompt_length_error(prompt_length)
+            if error is not None:
+                results[i] = error
+            else:
+                rows.append(i)
+        if not rows:
+            return results
+
+        # Prompts are left padded, so the remaining ones all fit in the last width columns
+        width = max(prompt_lengths[i] for i in rows)
+        inputs = {k: v[rows, -width:].to(DEVICE) for k, v in encoded.items()}
+
+        sequences, prompt_attentions, prompt_hidden_states = run_model(
+            model, tokenizer, inputs, return_attentions, generate, max_new_tokens, streamer
+        )
+
+        # Stack the per-layer tuples once so the whole batch comes back in a single device-to-host
+        # copy per kind, instead of one synchronizing .cpu() per layer and prompt.
+        # attentions shape: [num_layers, batch_size, num_heads, seq_len, seq_len]
+        # hidden_states shape: [num_layers + 1, batch_size, seq_len, hidden_size]
+        # Downcast to float16 before the copy: visualizations don't need float32 precision, and it
+        # halves both the transfer and the response payload.
+        attentions = torch.stack(prompt_attentions).half().cpu() if prompt_attentions else None
+        hidden_states = torch.stack(prompt_hidden_states).half().cpu() if prompt_hidden_states else None
+
+        for row, i in enumerate(rows):
+            prompt_length = prompt_lengths[i]
+            result = {
+                "generated_text": tokenizer.decode(sequences[row], skip_special_tokens=True) if sequences is not None else "",
+                "attentions": torch.empty(0),
+                "hidden_states": torch.empty(0),
+            }
+            # Select this prompt and strip its left padding
+            if attentions is not None:
+                result["attentions"] = attentions[:, row, :, -prompt_length:, -prompt_length:]
+            if hidden_states is not None:
+                result["hidden_states"] = hidden_states[:, row, -prompt_length:]
+            results[i] = result
+        return results
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error during inference: {str(e)}")
+
+class PendingBatch:
+    """Prompts collected for one model while its batching window is open."""
+    def __init__(self):
+        self.prompts = []
+        self.futures = []
+        self.full = asyncio.Event()
+        self.task = None
+
+# Open batch per (model name, return_attentions, generate, max_new_tokens); closed (removed) once
+# it is full or its window has elapsed. Only requests that run the same model variant with the
+# same generation settings can share a batch.
+pending_batches: dict[tuple, PendingBatch] = {}
+
+async def run_pending_batch(key: tuple, batch: PendingBatch):
+    """Wait out batch's window, run it, and resolve the future of every request in it.
+
+    Runs as its own task rather than inside any one request, so a request that is cancelled
+    (e.g. its client disconnected) cannot leave the rest of the batch waiting forever.
+    """
+    model_name, return_attentions, generate, max_new_tokens = key
+    results = None
+    try:
+        try:
+            await asyncio.wait_for(batch.full.wait(), timeout=BATCH_WINDOW_MS / 1000)
+        except asyncio.TimeoutError:
+            pass
+        if pending_batches.get(key) is batch:
+            del pending_batches[key]
+
+        # Inference is blocking CPU/GPU work; keep it off the event loop so other requests
+        # (including the next batch) are still accepted while it runs.
+        async with INFER_SEMAPHORE:
+            results = await run_in_threadpool(
+                run_batch, model_name, batch.prompts, return_attentions, generate, max_new_tokens
+            )
+    except Exception as e:
+        results = [e] * len(batch.futures)
+    finally:
+        if pending_batches.get(key) is batch:
+            del pending_batches[key]
+        if results is None:
+            # The batch task itself was cancelled (e.g. at shutdown)
+            results = [HTTPException(status_code=503, detail="Inference was cancelled.")] * len(batch.futures)
+        for batch_future, result in zip(batch.futures, results):
+            if batch_future.done():
+                # That request was cancelled while waiting; nobody is left to receive its result
+                continue
+            if isinstance(result, Exception):
+                batch_future.set_exception(result)
+            else:
+                batch_future.set_result(result)
+
+async def batched_infer(
+    prompt: str,
+    model_name: str,
+    return_attentions: bool = True,
+    generate: bool = True,
+    max_new_tokens: int = 50,
+):
+    """Add prompt to the open batch for model_name and wait for its share of the results.
+
+    The first request to arrive opens the batch and starts run_pending_batch(), which waits up
+    to BATCH_WINDOW_MS (or until BATCH_MAX_SIZE prompts have joined) and then runs it.
+    """
+    key = (model_name, return_attentions, generate, max_new_tokens)
+    batch = pending_batches.get(key)
+    if batch is None:
+        batch = pending_batches[key] = PendingBatch()
+        batch.task = asyncio.create_task(run_pending_batch(key, batch))
+
+    future = asyncio.get_running_loop().create_future()
+    batch.prompts.append(prompt)
+    batch.futures.append(future)
+    if len(batch.prompts) >= BATCH_MAX_SIZE:
+        # Later arrivals start a new batch; wake the batch task without waiting out the window.
+        if pending_batches.get(key) is batch:
+            del pending_batches[key]
+        batch.full.set()
+
+    return await future
+
+def encode_tensor(tensor):
+    """Pack a tensor as base64-encoded little-endian float16 bytes plus its shape.
+
+    Far cheaper to build and send than nested lists, which allocate a Python float per element.
+    """
+    # tobytes() writes native byte order; pin it so the format doesn't depend on the host.
+    data = tensor.to(torch.float16).contiguous().numpy().astype("<f2", copy=False).tobytes()
+    return {"shape": list(tensor.shape), "dtype": "float16", "data": base64.b64encode(data).decode("ascii")}
+
+def render_response(result, tensor_format: str, model_used_for_testing) -> bytes:
+    """Serialize a run_batch() result straight to JSON bytes in the requested tensor format."""
+    if tensor_format == "binary":
+        # One encoded tensor per layer
+        processed_attentions = [encode_tensor(layer) for layer in result["attentions"]]
+        processed_hidden_states = [encode_tensor(layer) for layer in result["hidden_states"]]
+    else:
+        # orjson writes numpy arrays as nested lists in C, without creating a Python float per
+        # element (it doesn't support float16 arrays, hence the upcast).
+        processed_attentions = result["attentions"].float().contiguous().numpy()
+        processed_hidden_states = result["hidden_states"].float().contiguous().numpy()
+
+    return orjson.dumps({
+        "generated_text": result["generated_text"],
+        "processed_attentions": processed_attentions,
+        "processed_hidden_states": processed_hidden_states,
+        "model_used_for_testing": model_used_for_testing,
+    }, option=orjson.OPT_SERIALIZE_NUMPY)
 
 class AnalyzeRequest(BaseModel):
     prompt: str
     model_name: str
+    # "json" returns attentions/hidden states as nested lists, "binary" as encode_tensor() dicts
+    tensor_format: Literal["json", "binary"] = "json"
+    # Attention maps need the slower eager attention; without them the fused SDPA kernel is used
+    return_attentions: bool = True
+    # Clients that only visualize attentions/hidden states can skip the generation loop entirely
+    generate: bool = True
+    max_new_tokens: int = Field(50, ge=1, le=256)
+
+def resolve_model_name(model_name: str) -> str:
+    """Apply MODEL_SUBSTITUTIONS and reject models outside ALLOWED_MODELS with a 400."""
+    model_name_to_use = MODEL_SUBSTITUTIONS.get(model_name, model_name)
+    if model_name_to_use != model_name:
+        print(f"Using {model_name_to_use} instead of {model_name} for testing purposes.")
+    if model_name_to_use not in ALLOWED_MODELS:
+        raise HTTPException(status_code=400, detail=f"Unsupported model: {model_name}")
+    return model_name_to_use
+
+def sse_event(event: str, data: bytes) -> str:
+    """Format one Server-Sent Event; data must be single-line JSON."""
+    return f"event: {event}\ndata: {data.decode()}\n\n"
 
 @app.post("/api/analyze")
 async def analyze_endpoint(request: AnalyzeRequest):
-    model_name_to_use = request.model_name
-    # Using a smaller model for testing purposes if a large model is specified.
-    # This is to avoid long download times in the execution environment.
-    # The code is structured to work with larger models like "meta-llama/Meta-Llama-3-8B-Instruct".
-    if request.model_name in ["meta-llama/Meta-Llama-3-8B-Instruct", "mistralai/Mistral-7B-Instruct-v0.2"]:
-        print(f"Using distilgpt2 instead of {request.model_name} for testing purposes.")
-        model_name_to_use = "distilgpt2"
+    model_name_to_use = resolve_model_name(request.model_name)
+
+    result = await batched_infer(
+        request.prompt,
+        model_name_to_use,
+        request.return_attentions,
+        request.generate,
+        request.max_new_tokens,
+    )
+    # Building the (potentially large) payload is blocking work too. Returning the bytes directly
+    # also skips FastAPI's pure-Python jsonable_encoder pass over the nested data.
+    content = await run_in_threadpool(
+        render_response,
+        result,
+        request.tensor_format,
+        model_name_to_use if model_name_to_use != request.model_name else None,
+    )
+    return Response(content=content, media_type="application/json")
+
+@app.post("/api/analyze/stream")
+async def analyze_stream_endpoint(request: AnalyzeRequest):
+    """Same analysis as /api/analyze, streamed as Server-Sent Events.
 
+    Emits a "token" event per chunk of generated text as soon as it is decoded, then a single
+    "result" event carrying the usual /api/analyze response body (or an "error" event).
+    Streaming runs one prompt per generate() call, so these requests are not batched.
+    """
+    model_name_to_use = resolve_model_name(request.model_name)
+    model_used_for_testing = model_name_to_use if model_name_to_use != request.model_name else None
+
+    # Fail with a proper status code while we still can, i.e. before the stream has started
     try:
-        tokenizer = AutoTokenizer.from_pretrained(model_name_to_use)
-        model = AutoModelForCausalLM.from_pretrained(model_name_to_use)
+        tokenizer, _ = await run_in_threadpool(get_model, model_name_to_use, request.return_attentions)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error loading model: {str(e)}")
+    encoded = await run_in_threadpool(tokenizer, request.prompt, return_tensors="pt")
+    error = prompt_length_error(encoded["input_ids"].shape[1])
+    if error is not None:
+        raise error
 
-    try:
-        inputs = tokenizer(request.prompt, return_tensors="pt")
-
-        # Ensure pad_token_id is set for open-ended generation if not already set
-        if model.config.pad_token_id is None:
-            model.config.pad_token_id = tokenizer.eos_token_id
-
-        # Using model.generate for simplicity in this step
-        # For more detailed control over outputs like attentions and hidden states from specific layers,
-        # a direct forward pass: model(**inputs, output_attentions=True, output_hidden_states=True) would be better.
-        # The .generate() method can also be configured for some of these, but it's more complex.
-        # For now, we will check for these attributes after a forward pass.
-
-        # Perform a forward pass to get hidden states and attentions
-        # Note: for generate, we'd typically get decoder_hidden_states and decoder_attentions
-        # if the model is an encoder-decoder. For decoder-only models (like GPT2),
-        # hidden_states and attentions are standard.
-        outputs = model(**inputs, output_attentions=True, output_hidden_states=True)
-
-        # For generation, let's use the generate method separately
-        # Max length is kept short for testing
-        generated_ids = model.generate(**inputs, max_length=50, pad_token_id=tokenizer.eos_token_id)
-        generated_text = tokenizer.decode(generated_ids[0], skip_special_tokens=True)
-
-        processed_attentions = []
-        if hasattr(outputs, 'attentions') and outputs.attentions:
-            for layer_attention in outputs.attentions:
-                # layer_attention shape: [batch_size, num_heads, seq_len, seq_len]
-                # Squeeze batch_size, convert to list
-                processed_attentions.append(layer_attention[0].cpu().tolist())
-
-        processed_hidden_states = []
-        if hasattr(outputs, 'hidden_states') and outputs.hidden_states:
-            for layer_hidden_state in outputs.hidden_states:
-                # layer_hidden_state shape: [batch_size, seq_len, hidden_size]
-                # Squeeze batch_size, convert to list
-                processed_hidden_states.append(layer_hidden_state[0].cpu().tolist())
-
-        return {
-            "generated_text": generated_text,
-            "processed_attentions": processed_attentions,
-            "processed_hidden_states": processed_hidden_states,
-            "model_used_for_testing": model_name_to_use if model_name_to_use != request.model_name else None
-        }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error during inference: {str(e)}")
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+
+    def run_streaming():
+        try:
+            return run_batch(
+                model_name_to_use,
+                [request.prompt],
+                request.return_attentions,
+                request.generate,
+                request.max_new_tokens,
+                streamer,
+            )[0]
+        finally:
+            # Unblock the token loop below even if generate() failed or never ran
+            streamer.end()
+
+    async def run_inference(slot_acquired: asyncio.Event):
+        # Runs as its own task so the concurrency slot is held until generate() has really
+        # finished, even if the client disconnects and events() is abandoned part-way.
+        async with INFER_SEMAPHORE:
+            slot_acquired.set()
+            try:
+                return await run_in_threadpool(run_streaming)
+            except HTTPException as e:
+                return e
+
+    async def events():
+        slot_acquired = asyncio.Event()
+        inference = asyncio.ensure_future(run_inference(slot_acquired))
+        # Reading the streamer parks a worker thread until text arrives, so only start once this
+        # request holds its slot. Otherwise queued streams could take every worker thread,
+        # including the one the running generate() needs, and stall the whole server.
+        try:
+            await slot_acquired.wait()
+        except BaseException:
+            if not slot_acquired.is_set():
+                inference.cancel()
+            raise
+        async for text in iterate_in_threadpool(streamer):
+            if text:
+                yield sse_event("token", orjson.dumps({"token": text}))
+        result = await inference
+        if isinstance(result, HTTPException):
+            yield sse_event("error", orjson.dumps({"detail": result.detail}))
+            return
+        content = await run_in_threadpool(render_response, result, request.tensor_format, model_used_for_testing)
+        yield sse_event("result", content)
+
+    return StreamingResponse(events(), media_type="text/event-stream")